@@ -8,8 +8,487 @@
 # OF ANY KIND, either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+import os
 from umapi_cli.version import __version__
 
 
 def test_version():
     assert __version__ == '2.2.0'
+
+
+def test_error_sink_output_is_valid_input():
+    import io
+    from umapi_cli.formatter import ErrorSink, InputHandler, CSVFormatter
+
+    handler = InputHandler('group_delete_bulk')
+    fh = io.StringIO()
+    sink = ErrorSink(fh, 'csv', handler.get_fields())
+    sink.write(3, {'name': 'Test Group'}, [{'errorCode': 'error.group.not_found', 'message': 'not found'}])
+    assert fh.getvalue() == ('source_row,error,name\n'
+                             '3,error.group.not_found: not found,Test Group\n')
+    fh.seek(0)
+    assert CSVFormatter(fh, handler).read() == [{'name': 'Test Group'}]
+
+
+def test_error_sink_round_trip_null_fields():
+    import io
+    from umapi_cli.formatter import ErrorSink, InputHandler, CSVFormatter, JSONFormatter
+
+    handler = InputHandler('user_create_bulk')
+    record = JSONFormatter(io.StringIO('{"type": "federatedID", "email": "user@example.com", "firstname": null, '
+                                       '"lastname": null, "country": null, "username": null, "domain": null, '
+                                       '"groups": null}\n'), handler).read()[0]
+    for data_format, reader in (('csv', CSVFormatter), ('json', JSONFormatter)):
+        fh = io.StringIO()
+        ErrorSink(fh, data_format, handler.get_fields()).write(1, record, [{'message': 'failed'}])
+        fh.seek(0)
+        retry = reader(fh, handler).read()[0]
+        assert retry['email'] == 'user@example.com' and retry['country'] is None
+        assert not retry['groups']
+
+
+def test_snapshot_delta(tmp_path):
+    from umapi_cli.snapshot import Snapshot
+
+    path = str(tmp_path / 'users.snapshot')
+    fields = ['id', 'email', 'groups']
+    snapshot = Snapshot(path, fields)
+    assert snapshot.compare({'id': '1', 'email': 'a@example.com', 'groups': ['a', 'b']}) == 'added'
+    assert snapshot.compare({'id': '2', 'email': 'b@example.com', 'groups': []}) == 'added'
+    snapshot.save()
+
+    snapshot = Snapshot(path, fields)
+    assert snapshot.compare({'id': '1', 'email': 'a@example.com', 'groups': ['b', 'a']}) is None
+    assert snapshot.compare({'id': '3', 'email': 'c@example.com', 'groups': []}) == 'added'
+    assert list(snapshot.removed()) == [{'id': '2', 'email': 'b@example.com'}]
+
+
+def test_reference_check():
+    from umapi_cli.preflight import ReferenceCheck
+
+    check = ReferenceCheck('group_update_bulk', ['Test Group', 'Adobe Stock'], ['user@example.com'])
+    record = {
+        'name': 'test group',
+        'add_users': ['USER@example.com', 'other@example.com'],
+        'add_profiles': ['Adobe Stok'],
+        'remove_profiles': None,
+    }
+    assert check.check(4, record) == [(4, 'user', 'other@example.com'), (4, 'group', 'Adobe Stok')]
+
+
+def test_users_snapshot_must_exist(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    from umapi_cli import cli, client
+
+    monkeypatch.setattr(client, 'create_conn', lambda conf, test_mode: RecordingConnection())
+    monkeypatch.chdir(tmp_path)
+    for key in ('UMAPI_CLIENT_ID', 'UMAPI_CLIENT_SECRET', 'UMAPI_ORG_ID'):
+        monkeypatch.setenv(key, 'test')
+    (tmp_path / 'upd.csv').write_text('email,firstname\nu1@example.com,Test\n')
+    result = CliRunner().invoke(cli.app, ['user-update-bulk', '-i', 'upd.csv', '--users-snapshot', 'typo.snap'])
+    assert result.exit_code == 2
+    assert "'typo.snap' does not exist" in result.output
+
+
+class FakeConnection:
+    """Serves users from memory in pages of two"""
+
+    def __init__(self, users):
+        self.users = users
+        self.single_queries = 0
+
+    def query_multiple(self, object_type, page=0, url_params=None, query_params=None):
+        values = self.users[page*2:page*2+2]
+        page_count = (len(self.users) + 1) // 2
+        return values, page >= page_count - 1, len(self.users), page_count, page + 1, 2
+
+    def query_single(self, object_type, url_params, query_params=None):
+        self.single_queries += 1
+        return next((u for u in self.users if u['email'] == url_params[0]), {})
+
+
+def test_user_lookup():
+    from umapi_cli.lookup import UserLookup
+
+    users = [{'email': f'user{i}@example.com'} for i in range(6)]
+    conn = FakeConnection(users)
+    found = UserLookup(conn).lookup(['USER1@example.com', 'missing@example.com'])
+    assert found == {'user1@example.com': users[1]}
+    assert conn.single_queries == 2
+
+    conn = FakeConnection(users)
+    found = UserLookup(conn).lookup([u['email'] for u in users[:4]] + ['missing@example.com'])
+    assert len(found) == 4
+    assert conn.single_queries == 0
+
+
+def test_user_stream_drops_pages():
+    # UserStream relies on QueryMultiple internals, so check it against the real umapi_client paging
+    from umapi_cli.lookup import UserStream
+
+    users = [{'email': f'user{i}@example.com'} for i in range(5)]
+    query = UserStream(FakeConnection(users))
+    seen = []
+    for user in query:
+        assert len(query._results) <= 2
+        seen.append(user)
+    assert seen == users
+    assert query.stats()[:2] == (5, 3)
+    assert [u['email'] for u in query] == [u['email'] for u in users]
+
+
+def test_user_record_csv():
+    import io
+    from umapi_cli.formatter import CSVFormatter, OutputHandler
+    from umapi_cli.record import UserRecord
+
+    user = UserRecord.from_dict({'id': '1', 'email': 'user@example.com', 'groups': ['A', 'B'], 'other': 'x'})
+    assert 'firstname' not in user
+    assert user.get('groups') == ('A', 'B')
+    fh = io.StringIO()
+    fmtr = CSVFormatter(fh, OutputHandler('user_read_all'))
+    fmtr.record(user)
+    fmtr.write()
+    assert fh.getvalue() == ('id,type,email,firstname,lastname,country,username,domain,groups,tags\n'
+                             '1,,user@example.com,,,,,,"A,B",\n')
+
+
+def test_external_sort():
+    from umapi_cli.sort import ExternalSort
+    from umapi_cli.record import UserRecord
+
+    sorter = ExternalSort('email', chunk_size=3)
+    emails = ['d@example.com', 'B@example.com', 'a@example.com', 'e@example.com', 'c@example.com']
+    for i, email in enumerate(emails):
+        sorter.add(UserRecord(id=str(i), email=email, groups=['x']))
+    assert len(sorter.spills) == 1
+    records = list(sorter.sorted())
+    assert [r['email'] for r in records] == sorted(emails, key=str.lower)
+    assert sorter.tmp_dir is None
+
+
+class RecordingConnection:
+    """Records the command and frame of each executed action"""
+
+    throttle_actions = 2
+
+    def __init__(self):
+        self.batches = []
+
+    def execute_multiple(self, actions, immediate=True):
+        self.batches.append([(next(iter(a.commands[0])), a.frame) for a in actions])
+
+    def commands(self):
+        return [c for batch in self.batches for c, _ in batch]
+
+
+def test_action_queue_stages():
+    from umapi_cli.action_queue import ActionQueue
+
+    conn = RecordingConnection()
+    queue = ActionQueue(conn)
+    queue.queue_group_delete_action('Old Group')
+    queue.queue_group_delete_action('Older Group')
+    queue.queue_update_action('user2@example.com', firstname='Test')
+    queue.queue_delete_action('user2@example.com')
+    queue.queue_delete_action('user3@example.com')
+    queue.queue_user_create_action('federatedID', 'user1@example.com', 'US', groups=['New Group'])
+    queue.queue_update_action('user1@example.com', firstname='Test')
+    queue.queue_group_create_action('New Group', None)
+    assert queue.execute() == 8
+    commands = conn.commands()
+    # independent deletes go first, then the stages in order
+    assert commands[:3] == ['removeFromOrg', 'deleteUserGroup', 'deleteUserGroup']
+    assert all(len(batch) == 1 for batch in conn.batches[1:3])
+    assert commands[3:] == ['createUserGroup', 'createFederatedID', 'update', 'update', 'removeFromOrg']
+
+
+def test_action_queue_keeps_order_per_target():
+    from umapi_cli.action_queue import ActionQueue
+
+    conn = RecordingConnection()
+    queue = ActionQueue(conn, workers=4)
+    queue.queue_delete_action('a@example.com', True)
+    queue.queue_user_create_action('federatedID', 'a@example.com', 'US')
+    queue.queue_group_delete_action('G')
+    queue.queue_group_create_action('G', None)
+    queue.queue_group_update_action('Old', 'New', None, None, None, None, None)
+    queue.queue_group_update_action('New', None, 'Renamed group', None, None, None, None)
+    queue.execute()
+    order = [(c, list(f.values())[0]) for batch in conn.batches for c, f in batch]
+    assert order.index(('removeFromOrg', 'a@example.com')) < order.index(('createFederatedID', 'a@example.com'))
+    assert order.index(('deleteUserGroup', 'G')) < order.index(('createUserGroup', 'G'))
+    assert order[-1] == ('updateUserGroup', 'New')
+
+
+def test_operation_handler():
+    import pytest
+    from schema import SchemaError
+    from umapi_cli.formatter import OperationHandler
+
+    handler = OperationHandler()
+    assert handler.get_fields()[0] == 'op'
+    rec = handler.handle({'op': 'User-Delete', 'email': 'user@example.com', 'hard_delete': 'Y', 'name': ''})
+    assert rec == {'email': 'user@example.com', 'hard_delete': 'y', 'op': 'user_delete'}
+    assert handler.handle({'op': 'group_update', 'name': 'Test Group'})['add_users'] is None
+    with pytest.raises(SchemaError):
+        handler.handle({'op': 'group_rename', 'name': 'Test Group'})
+    with pytest.raises(SchemaError):
+        handler.handle({'op': 'group_delete', 'name': 'Test Group', 'email': 'user@example.com'})
+    with pytest.raises(SchemaError):
+        handler.handle({'op': 5, 'name': 'Test Group'})
+    with pytest.raises(SchemaError):
+        handler.handle(['group_delete'])
+
+
+def test_bulk_apply_conflicting_ops():
+    import io
+    from umapi_cli.action_queue import ActionQueue
+    from umapi_cli.formatter import CSVFormatter, OperationHandler
+
+    fh = io.StringIO('op,email,hard_delete,type,country,name,name_new,description\n'
+                     'user_delete,a@example.com,y,,,,,\n'
+                     'user_create,a@example.com,,federatedID,US,,,\n'
+                     'group_delete,,,,,G,,\n'
+                     'group_create,,,,,G,,\n'
+                     'group_update,,,,,Old,New,\n'
+                     'group_update,,,,,New,,Renamed\n')
+    conn = RecordingConnection()
+    queue = ActionQueue(conn, workers=4)
+    for record in CSVFormatter(fh, OperationHandler()).read():
+        queue.queue_operation(record['op'], record)
+    queue.execute()
+    order = [(c, list(f.values())[0]) for batch in conn.batches for c, f in batch]
+    assert order.index(('removeFromOrg', 'a@example.com')) < order.index(('createFederatedID', 'a@example.com'))
+    assert order.index(('deleteUserGroup', 'G')) < order.index(('createUserGroup', 'G'))
+    assert order.index(('updateUserGroup', 'Old')) < order.index(('updateUserGroup', 'New'))
+
+
+def test_bulk_apply_preflight_renames(tmp_path, monkeypatch):
+    import json
+    from click.testing import CliRunner
+    from umapi_cli import cli, client
+    from umapi_cli.snapshot import Snapshot
+
+    class GroupConnection(RecordingConnection):
+        def query_multiple(self, object_type, page=0, url_params=None, query_params=None):
+            return [{'groupName': 'Old'}], True, 1, 1, 1, 1
+
+    conn = GroupConnection()
+    monkeypatch.setattr(client, 'create_conn', lambda conf, test_mode: conn)
+    monkeypatch.chdir(tmp_path)
+    for key in ('UMAPI_CLIENT_ID', 'UMAPI_CLIENT_SECRET', 'UMAPI_ORG_ID'):
+        monkeypatch.setenv(key, 'test')
+    snapshot = Snapshot('users.snapshot', ['id', 'email'])
+    snapshot.compare({'id': '1', 'email': 'old@example.com'})
+    snapshot.save()
+    records = [
+        {'op': 'group_update', 'name': 'Old', 'name_new': 'New'},
+        {'op': 'user_update', 'email': 'old@example.com', 'email_new': 'new@example.com'},
+        {'op': 'group_update', 'name': 'New', 'add_users': ['new@example.com']},
+        {'op': 'user_update', 'email': 'new@example.com', 'add_groups': ['New']},
+    ]
+    (tmp_path / 'ops.jsonl').write_text(''.join(json.dumps(r) + '\n' for r in records))
+    result = CliRunner().invoke(cli.app, ['bulk-apply', '-f', 'json', '-i', 'ops.jsonl',
+                                          '--users-snapshot', 'users.snapshot'])
+    assert result.exit_code == 0, result.output
+    assert len(conn.commands()) == 4
+
+
+def test_watcher_tail(tmp_path):
+    from umapi_cli.formatter import OperationHandler
+    from umapi_cli.watch import Watcher
+
+    feed = tmp_path / 'feed.jsonl'
+    feed.write_text('{"name": "Group 1"}\n{"name": "Group 2"}\n{"name": "Gro')
+    watcher = Watcher(str(feed), OperationHandler('group_delete'), batch_size=1)
+    batches = watcher.batches()
+    records, commit = next(batches)
+    assert records == [(1, {'name': 'Group 1', 'op': 'group_delete'})]
+    commit()
+    batches.close()
+
+    # uncommitted records are read again, partially written lines are not read yet
+    assert [r for records, _ in watcher.batches() for r in records] == [(2, {'name': 'Group 2', 'op': 'group_delete'})]
+    with open(feed, 'a') as fh:
+        fh.write('up 3"}\n')
+    assert [row for records, _ in watcher.batches() for row, _ in records] == [2, 3]
+
+
+def test_watcher_skips_invalid_records(tmp_path):
+    from umapi_cli.formatter import OperationHandler
+    from umapi_cli.watch import Watcher
+
+    feed = tmp_path / 'feed.jsonl'
+    feed.write_text('[1]\n{"op": 5}\nnot json\n{"op": "group_delete", "name": "Group 1"}\n')
+    invalid = []
+    watcher = Watcher(str(feed), OperationHandler(), on_invalid=lambda row, record, message: invalid.append(row))
+    assert [row for records, _ in watcher.batches() for row, _ in records] == [4]
+    assert invalid == [1, 2, 3]
+
+
+def test_watch_command_continues_after_errors(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    from umapi_client import BatchError
+    from umapi_cli import cli, client
+
+    class FailingConnection(RecordingConnection):
+        def execute_multiple(self, actions, immediate=True):
+            if not self.batches:
+                self.batches.append([])
+                raise BatchError([Exception('unavailable')], 0, len(actions), 0)
+            super().execute_multiple(actions, immediate)
+
+    conn = FailingConnection()
+    monkeypatch.setattr(client, 'create_conn', lambda conf, test_mode: conn)
+    monkeypatch.chdir(tmp_path)
+    for key in ('UMAPI_CLIENT_ID', 'UMAPI_CLIENT_SECRET', 'UMAPI_ORG_ID'):
+        monkeypatch.setenv(key, 'test')
+    feed = tmp_path / 'feed.jsonl'
+    feed.write_text('{"op": "group_create", "name": "_bad"}\n{"op": "group_create", "name": "Group 1"}\n')
+    args = ['watch', str(feed), '--once', '--errors-out', str(tmp_path / 'errors.jsonl')]
+
+    # the batch is not committed when executing it fails, so the next run executes it again
+    assert CliRunner().invoke(cli.app, args).exit_code == 1
+    result = CliRunner().invoke(cli.app, args)
+    assert result.exit_code == 0
+    assert conn.commands() == ['createUserGroup']
+    errors = (tmp_path / 'errors.jsonl').read_text().splitlines()
+    assert len(errors) == 2 and all('"source_row": 1' in e for e in errors)
+
+
+def test_watch_command_writes_non_object_records_to_errors(tmp_path, monkeypatch):
+    import json
+    from click.testing import CliRunner
+    from umapi_cli import cli, client
+
+    conn = RecordingConnection()
+    monkeypatch.setattr(client, 'create_conn', lambda conf, test_mode: conn)
+    monkeypatch.chdir(tmp_path)
+    for key in ('UMAPI_CLIENT_ID', 'UMAPI_CLIENT_SECRET', 'UMAPI_ORG_ID'):
+        monkeypatch.setenv(key, 'test')
+    feed = tmp_path / 'feed.jsonl'
+    feed.write_text('[1]\n"str"\n5\n{"op": "group_create", "name": "Group 1"}\n')
+    for errors_out in ('errors.jsonl', 'errors.csv'):
+        state_file = tmp_path / f'{errors_out}.offset'
+        result = CliRunner().invoke(cli.app, ['watch', str(feed), '--once', '--errors-out', errors_out,
+                                              '--state-file', str(state_file)])
+        assert result.exit_code == 0, result.output
+        assert json.loads(state_file.read_text()) == {'offset': feed.stat().st_size, 'line': 4}
+    errors = (tmp_path / 'errors.jsonl').read_text().splitlines()
+    assert [json.loads(e)['source_row'] for e in errors] == [1, 2, 3]
+    assert (tmp_path / 'errors.csv').read_text().splitlines()[1].startswith('1,')
+    assert conn.commands() == ['createUserGroup', 'createUserGroup']
+
+
+def test_output_sink_parts(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from umapi_cli.formatter import OutputSink
+
+    sink = OutputSink(str(tmp_path / 'users.csv'), max_bytes=64, repeat_header=True, buffer_size=16)
+    sink.write('id,email\n')
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda i: sink.write(f"{i:02d},user{i:02d}@example.com\n"), range(20)))
+    sink.close()
+    assert [os.path.basename(p) for p in sink.paths][:2] == ['users.0001.csv', 'users.0002.csv']
+    rows = []
+    for path in sink.paths:
+        with open(path) as fh:
+            lines = fh.read().splitlines()
+        assert lines[0] == 'id,email'
+        assert os.path.getsize(path) <= 64
+        rows.extend(lines[1:])
+    assert sorted(rows) == [f"{i:02d},user{i:02d}@example.com" for i in range(20)]
+
+
+def test_batch_sizer():
+    from umapi_cli.action_queue import BatchSizer
+
+    sizer = BatchSizer(10)
+    assert sizer.update(10, 12.0, 1000, 0) == 5
+    assert sizer.update(5, 1.0, 1000, 4) == 2
+    assert sizer.update(2, 1.0, 1000, 0) == 3
+    assert sizer.update(3, 5.0, 1000, 0) == 3
+    for _ in range(20):
+        sizer.update(3, 0.5, 1000, 0)
+    assert sizer.size == 10
+
+
+def test_profile_options(tmp_path):
+    import pytest
+    from umapi_cli import config
+
+    config_file = tmp_path / 'config.toml'
+    config_file.write_text('[profiles.prod]\n'
+                           'client_id = "abc-123"\n'
+                           'client_secret = "xyz-9876"\n'
+                           'org_id = "ABC123@AdobeOrg"\n'
+                           '[profiles.stage]\n'
+                           'client_id = "def-456"\n')
+    options = config.get_profile_options('prod', str(config_file))
+    assert options['UMAPI_CLIENT_ID'] == 'abc-123'
+    assert options['UMAPI_ORG_ID'] == 'ABC123@AdobeOrg'
+    assert options['UMAPI_URL'] is None
+    with pytest.raises(ValueError):
+        config.get_profile_options('stage', str(config_file))
+    with pytest.raises(ValueError):
+        config.get_profile_options('dev', str(config_file))
+
+
+def test_profiling_report(tmp_path):
+    from umapi_cli import profiling
+
+    path = str(tmp_path / 'run.prof')
+    profiling.start()
+    profiling.mark('input')
+    sorted(range(1000), key=str)
+    profiling.mark('execute')
+    profiling.stop(path, 'user-update-bulk')
+    assert os.path.getsize(path) > 0
+    with open(f"{path}.txt") as fh:
+        report = fh.read()
+    assert report.startswith('Command: user-update-bulk\n')
+    assert '   input     :' in report and '   execute   :' in report
+    # marks are ignored once profiling has stopped
+    profiling.mark('output')
+
+
+def test_quota_report():
+    from umapi_cli.quota import count_users, quota_report
+
+    groups = [
+        {'groupName': 'All Apps', 'type': 'PRODUCT_PROFILE', 'memberCount': 12, 'licenseQuota': '10'},
+        {'groupName': 'Stock', 'type': 'PRODUCT_PROFILE', 'memberCount': 1, 'licenseQuota': 'UNLIMITED'},
+        {'groupName': 'Team', 'type': 'USER_GROUP', 'memberCount': 3},
+    ]
+    counts = count_users([{'groups': ['All Apps', 'Team']}, {'groups': 'all apps,Stock'}])
+    report = list(quota_report(groups, counts))
+    assert [r['groupName'] for r in report] == ['All Apps', 'Stock']
+    assert report[0]['userCount'] == 2
+    assert (report[0]['utilisation'], report[0]['headroom'], report[0]['overAllocated']) == (120.0, -2, True)
+    assert (report[1]['utilisation'], report[1]['headroom'], report[1]['overAllocated']) == (None, None, False)
+    assert [r['groupName'] for r in quota_report(groups, over_allocated_only=True)] == ['All Apps']
+
+
+def test_quota_report_users_file(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    from umapi_cli import cli, client
+
+    class GroupConnection(FakeConnection):
+        def query_multiple(self, object_type, page=0, url_params=None, query_params=None):
+            assert object_type == 'group'
+            return [{'groupName': 'All Apps', 'type': 'PRODUCT_PROFILE', 'memberCount': 3,
+                     'licenseQuota': '2'}], True, 1, 1, 1, 1
+
+    monkeypatch.setattr(client, 'create_conn', lambda conf, test_mode: GroupConnection([]))
+    monkeypatch.chdir(tmp_path)
+    for key in ('UMAPI_CLIENT_ID', 'UMAPI_CLIENT_SECRET', 'UMAPI_ORG_ID'):
+        monkeypatch.setenv(key, 'test')
+    (tmp_path / 'users.csv').write_text('id,email,groups\n1,a@example.com,"All Apps,Team"\n2,b@example.com,\n'
+                                        '3,c@example.com,all apps\n')
+    result = CliRunner().invoke(cli.app, ['quota-report', '--users-file', 'users.csv', '-f', 'csv'])
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines() == [
+        'groupName,productName,memberCount,userCount,licenseQuota,utilisation,headroom,overAllocated',
+        'All Apps,,3,2,2,150.0,-1,True',
+    ]
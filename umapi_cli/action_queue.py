@@ -8,34 +8,248 @@
 # OF ANY KIND, either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+import json
 import re
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import umapi_client
 from umapi_client import UserAction, GroupAction
 from .formatter import normalize
 from . import log
 
 
+# execution stages - every action in a stage is executed before the next stage
+# starts, so actions can rely on objects created or updated in earlier stages.
+# Actions on the same user or group are never reordered across stages, see
+# ActionQueue._schedule
+STAGE_GROUP_CREATE = 0
+STAGE_USER_CREATE = 1
+STAGE_GROUP_UPDATE = 2
+STAGE_USER_UPDATE = 3
+STAGE_DELETE = 4
+STAGE_GROUP_DELETE = 5
+
+# stages of actions that are executed before all other actions when nothing
+# else in the queue touches their user or group
+PRIORITY_STAGES = (STAGE_DELETE, STAGE_GROUP_DELETE)
+# stages that only create objects, so they may run before earlier actions that
+# reference the object
+CREATE_STAGES = (STAGE_GROUP_CREATE, STAGE_USER_CREATE)
+
+
+def _user(name):
+    return ('user', normalize(name))
+
+
+def _group(name):
+    return ('group', normalize(name))
+
+
+class BatchSizer:
+    """Choose the number of actions sent per call from the results of earlier calls
+
+    The batch size starts at the maximum. It is halved after a call that is
+    slow, has a large payload or where most actions fail, and grows by one
+    after a fast call.
+    """
+
+    fast_seconds = 2.0
+    slow_seconds = 10.0
+    max_payload = 256 * 1024
+    max_error_rate = 0.5
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.size = maximum
+
+    def update(self, actions, elapsed, payload, errors):
+        if (elapsed >= self.slow_seconds or payload >= self.max_payload
+                or errors / actions > self.max_error_rate):
+            self.size = max(self.minimum, self.size // 2)
+        elif elapsed < self.fast_seconds:
+            self.size = min(self.maximum, self.size + 1)
+        return self.size
+
+
 class ActionQueue:
 
-    def __init__(self, conn):
+    def __init__(self, conn, error_sink=None, workers=1):
         self.actions = []
+        self.sources = []
+        self.stages = []
+        self.writes = []
+        self.reads = []
         self.conn = conn
+        self.error_sink = error_sink
+        self.error_count = 0
+        self.workers = workers
+        self._source = None
+        self._lock = threading.Lock()
+        self._completed = 0
+        # the UMAPI accepts up to throttle_actions actions per call
+        self.sizer = BatchSizer(conn.throttle_actions)
+
+    def set_source(self, row, record):
+        """Associate actions queued from now on with an input row and record"""
+        self._source = (row, record)
 
-    def push(self, user_action):
+    def push(self, user_action, stage=STAGE_USER_UPDATE, writes=None, reads=()):
+        """Queue an action
+
+        writes are the ('user'|'group', name) objects the action changes, the
+        first being the one it acts on. reads are the objects it references,
+        e.g. the groups a user is added to.
+        """
+        if writes is None:
+            kind = 'group' if 'usergroup' in user_action.frame else 'user'
+            writes = [(kind, normalize(str(next(iter(user_action.frame.values()), ''))))]
         self.actions.append(user_action)
+        self.sources.append(self._source)
+        self.stages.append(stage)
+        self.writes.append(tuple(writes))
+        self.reads.append(tuple(reads))
+
+    def clear(self):
+        """Drop all queued actions so the queue can be reused for the next batch"""
+        self.actions = []
+        self.sources = []
+        self.stages = []
+        self.writes = []
+        self.reads = []
 
     def execute(self):
-        completed = 0
         queued = len(self.actions)
+        self._completed = 0
         log.info(f'Number of actions to execute: {len(self.actions)}')
-        for action in self.actions:
-            self.conn.execute_single(action)
-            completed += 1
-            if completed % 10 == 0:
-                log.info(f"Executed actions: {completed}/{queued} ({round(completed/queued*100, 2)}%)")
-        self.conn.execute_queued()
-        log.info(f"Executed actions: {completed}/{queued} ({round(completed/queued*100, 2)}%)")
-        return completed
+        steps = {}
+        for i, key in enumerate(self._schedule()):
+            steps.setdefault(key, []).append(i)
+        for (epoch, stage), indexes in sorted(steps.items()):
+            lanes = self._lanes(indexes)
+            log.debug(f"Executing stage {stage} of {'priority actions' if epoch < 0 else f'round {epoch}'} "
+                      f"in {len(lanes)} lane(s)")
+            if len(lanes) == 1:
+                self._execute_lane(lanes[0], stage, queued)
+                continue
+            with ThreadPoolExecutor(max_workers=len(lanes)) as executor:
+                for f in [executor.submit(self._execute_lane, lane, stage, queued) for lane in lanes]:
+                    f.result()
+        return self._completed
+
+    def _schedule(self):
+        """Return the (round, stage) in which each action is executed
+
+        Actions run in stage order, but an action never runs before an earlier
+        action that changes the same user or group, or a group or user it
+        references. When the stage order would do that, the action moves to
+        the next round. Creates may run before earlier actions that only
+        reference the created object. Actions sharing a target share a lane,
+        so they may run in the same round and stage.
+
+        Deletes of users and groups that no other action touches are
+        independent of the rest of the queue and run first, in round -1.
+        """
+        touched = Counter(o for i in range(len(self.actions)) for o in set(self.writes[i] + self.reads[i]))
+        last_write = {}
+        last_read = {}
+        keys = []
+        for stage, writes, reads in zip(self.stages, self.writes, self.reads):
+            if stage in PRIORITY_STAGES and all(touched[o] == 1 for o in writes):
+                keys.append((-1, stage))
+                continue
+            target = writes[0]
+            deps = [last_write[o] for o in writes + reads if o in last_write]
+            if stage not in CREATE_STAGES:
+                deps.extend(last_read[o] for o in writes if o in last_read)
+            epoch = 0
+            for (dep_epoch, dep_stage), dep_target in deps:
+                same_lane = dep_target == target
+                epoch = max(epoch, dep_epoch if dep_stage < stage or (dep_stage == stage and same_lane)
+                            else dep_epoch + 1)
+            key = (epoch, stage)
+            for o in writes:
+                last_write[o] = (key, target)
+            for o in reads:
+                last_read[o] = max(last_read.get(o, (key, target)), (key, target))
+            keys.append(key)
+        return keys
+
+    def _lanes(self, indexes):
+        """Split action indexes into lanes that can be executed concurrently
+
+        Actions on the same user or group always share a lane, so they are
+        executed in the order they were queued.
+        """
+        lanes = [[] for _ in range(self.workers)]
+        for i in indexes:
+            target = self.writes[i][0][1]
+            lanes[zlib.crc32(target.encode('utf-8')) % self.workers].append(i)
+        return [lane for lane in lanes if lane]
+
+    def _execute_lane(self, indexes, stage, queued):
+        start = 0
+        while start < len(indexes):
+            # there is a bug in the UMAPI that prevents multiple group delete
+            # operations in a single action call
+            batch_size = 1 if stage == STAGE_GROUP_DELETE else self.sizer.size
+            batch = indexes[start:start+batch_size]
+            start += batch_size
+            actions = [self.actions[i] for i in batch]
+            payload = sum(len(json.dumps(a.wire_dict())) for a in actions)
+            started = time.perf_counter()
+            # send each batch right away so its errors can be reported while the run continues
+            self.conn.execute_multiple(actions, immediate=True)
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._completed += len(batch)
+                errors = self._report_errors(batch)
+                if stage != STAGE_GROUP_DELETE:
+                    self.sizer.update(len(batch), elapsed, payload, errors)
+                log.info(f"Batch: {len(batch)} actions, {payload} bytes, {elapsed:.2f}s, {errors} errors, "
+                         f"next batch size {self.sizer.size}")
+                log.info(f"Executed actions: {self._completed}/{queued} "
+                         f"({round(self._completed/queued*100, 2)}%)")
+
+    def _report_errors(self, indexes):
+        """Count and report actions with errors and return how many there were"""
+        count = 0
+        for i in indexes:
+            errors = self.actions[i].execution_errors()
+            if not errors:
+                continue
+            count += 1
+            if self.error_sink is not None:
+                row, record = self.sources[i] or (None, None)
+                self.error_sink.write(row, record, errors)
+        self.error_count += count
+        return count
+
+    def queue_operation(self, op, record):
+        """Queue the action for a record validated by OperationHandler"""
+        record = {k: v for k, v in record.items() if k != 'op'}
+        if op == 'user_create':
+            self.queue_user_create_action(id_type=record['type'],
+                                          email=record['email'], username=record['username'],
+                                          domain=record['domain'] or None, groups=record['groups'],
+                                          firstname=record['firstname'],
+                                          lastname=record['lastname'],
+                                          country=record['country'])
+        elif op == 'user_update':
+            self.queue_update_action(**record)
+        elif op == 'user_delete':
+            self.queue_delete_action(record['email'], record['hard_delete'] == 'y')
+        elif op == 'group_create':
+            self.queue_group_create_action(record['name'], record['description'])
+        elif op == 'group_update':
+            self.queue_group_update_action(**record)
+        elif op == 'group_delete':
+            self.queue_group_delete_action(record['name'])
+        else:
+            raise ValueError(f"Unknown operation '{op}'")
 
     def errors(self):
         return [a.execution_errors() for a in self.actions if a.execution_errors()]
@@ -48,14 +262,15 @@ class ActionQueue:
         user = UserAction(username, domain)
 
         user.create(email, firstname, lastname, country, id_type)
-        if groups is not None:
+        if groups:
             user.add_to_groups(groups)
-        self.push(user)
+        self.push(user, STAGE_USER_CREATE, writes=[_user(username), _user(email)],
+                  reads=[_group(g) for g in groups or []])
 
     def queue_group_create_action(self, name, description):
         group = GroupAction(name)
         group.create(description=description)
-        self.push(group)
+        self.push(group, STAGE_GROUP_CREATE)
 
     def queue_group_update_action(self, name, name_new, description, add_users,
                                   remove_users, add_profiles, remove_profiles):
@@ -70,19 +285,20 @@ class ActionQueue:
             group.add_to_products(add_profiles)
         if remove_profiles is not None:
             group.remove_from_products(remove_profiles)
-        self.push(group)
+        writes = [_group(name)] + ([_group(name_new)] if name_new else [])
+        reads = ([_user(u) for u in (add_users or []) + (remove_users or [])]
+                 + [_group(p) for p in (add_profiles or []) + (remove_profiles or [])])
+        self.push(group, STAGE_GROUP_UPDATE, writes=writes, reads=reads)
 
     def queue_group_delete_action(self, name):
-        # there is a bug in the UMAPI that prevents multiple group delete
-        # operations in a single action call
         group = GroupAction(name)
         group.delete()
-        self.conn.execute_single(group, immediate=True)
+        self.push(group, STAGE_GROUP_DELETE)
 
     def queue_delete_action(self, email, hard_delete=False):
         user = UserAction(email)
         user.remove_from_organization(hard_delete)
-        self.push(user)
+        self.push(user, STAGE_DELETE)
 
     def queue_update_action(self, email, **kwargs):
         user = UserAction(email)
@@ -105,4 +321,6 @@ class ActionQueue:
             user.add_to_groups(groups_to_add)
         if groups_to_remove:
             user.remove_from_groups(groups_to_remove)
-        self.push(user)
+        writes = [_user(email)] + ([_user(params['email'])] if params.get('email') else [])
+        self.push(user, STAGE_USER_UPDATE, writes=writes,
+                  reads=[_group(g) for g in list(groups_to_add or []) + list(groups_to_remove or [])])
@@ -12,15 +12,24 @@ import click
 import sys
 import io
 import os
-from umapi_client import UserQuery, UsersQuery, GroupsQuery
+import time
+from umapi_client import UserQuery, GroupsQuery, BatchError
 import dotenv
 from pathlib import Path
 from umapi_cli import config
 from umapi_cli import client
 from umapi_cli import formatter
 from umapi_cli.action_queue import ActionQueue
-from umapi_cli.formatter import normalize, InputHandler, OutputHandler, PassthroughHandler
+from umapi_cli.snapshot import Snapshot
+from umapi_cli.preflight import ReferenceCheck
+from umapi_cli.lookup import UserLookup, UserStream
+from umapi_cli.record import UserRecord
+from umapi_cli.sort import ExternalSort
+from umapi_cli.watch import Watcher
+from umapi_cli import quota
+from umapi_cli.formatter import normalize, InputHandler, OperationHandler, OutputHandler, PassthroughHandler
 from umapi_cli import log
+from umapi_cli import profiling
 from umapi_cli.version import __version__ as app_version
 
 def _formatter(data_format, fh, handler):
@@ -41,6 +50,42 @@ def _input_fh(in_file):
     return open(in_file, 'r')
 
 
+def _error_sink(errors_out, handler, input_format):
+    if errors_out is None:
+        return None
+    return formatter.ErrorSink(_output_fh(errors_out), infer_format(errors_out) or input_format,
+                               handler.get_fields())
+
+
+def _preflight(umapi_conn, fmt, records, users_snapshot=None):
+    """Exit before anything is sent if records reference unknown groups, profiles or users
+
+    fmt is the InputHandler format of the records, or None for bulk-apply records.
+    """
+    groups = [g['groupName'] for g in GroupsQuery(umapi_conn)]
+    users = None
+    if users_snapshot is not None:
+        users = Snapshot(users_snapshot, []).emails()
+    check = ReferenceCheck(fmt, groups, users)
+    if fmt is None:
+        # a bulk-apply stream may reference groups and users it creates or renames itself
+        check.add_known('group', [r['name'] for r in records if r['op'] == 'group_create'])
+        check.add_known('group', [r['name_new'] for r in records if r['op'] == 'group_update' and r['name_new']])
+        check.add_known('user', [r['email'] for r in records if r['op'] == 'user_create'])
+        check.add_known('user', [r['email_new'] for r in records if r['op'] == 'user_update' and r['email_new']])
+    unknown = []
+    for row, record in enumerate(records, start=1):
+        record_fmt = OperationHandler.operations[record['op']] if fmt is None else None
+        unknown.extend(check.check(row, record, record_fmt))
+    log.info(f"Pre-flight check: {len(records)} records, {len(unknown)} unknown references")
+    if not unknown:
+        return
+    click.echo("Unknown references found, no actions were executed")
+    for row, kind, name in unknown:
+        click.echo(f"   Row {row}: unknown {kind} '{name}'")
+    sys.exit(1)
+
+
 def infer_format(filename):
     if filename.endswith('csv'):
         return 'csv'
@@ -51,23 +96,42 @@ def infer_format(filename):
 
 @click.group()
 @click.option('--env', 'env_file', help="Path to .env file (optional)", default=None, type=click.Path())
+@click.option('--profile-name', help="Read config from this profile of the config file instead of .env",
+              envvar='UMAPI_PROFILE', metavar='NAME')
+@click.option('--config', 'config_file', help="Path to profile config file  [default: ~/.config/umapi/config.toml]",
+              default=None, type=click.Path(dir_okay=False))
 @click.option('-t', '--test', 'test_mode', help="Run command in test mode", default=False, show_default=False,
               is_flag=True)
 @click.option('-v', count=True, help="Enable verbose logging")
+@click.option('--profile', 'profile_file', help="Write a cProfile dump to this file and a phase timing report to "
+                                                "FILENAME.txt", metavar='FILENAME')
 @click.help_option('-h', '--help')
 @click.version_option(app_version, '--version', message='%(prog)s %(version)s')
 @click.pass_context
-def app(ctx, env_file, test_mode, v):
+def app(ctx, env_file, profile_name, config_file, test_mode, v, profile_file):
     log.init(v)
-    if env_file is not None:
-        dotenv.load_dotenv(env_file)
+    if profile_file is not None:
+        profiling.start()
+        profiling.mark('config')
+        ctx.call_on_close(lambda: profiling.stop(profile_file, ctx.invoked_subcommand))
+    ctx.ensure_object(dict)
+    if profile_name is not None:
+        if env_file is not None:
+            raise click.UsageError("--env and --profile-name can't be used together")
+        conf = config.get_profile_options(profile_name, config_file)
     else:
-        env_file = dotenv.find_dotenv(usecwd=True)
-        if env_file:
+        if env_file is not None:
             dotenv.load_dotenv(env_file)
-    ctx.ensure_object(dict)
-    conf = config.get_options()
+        else:
+            env_file = dotenv.find_dotenv(usecwd=True)
+            if env_file:
+                dotenv.load_dotenv(env_file)
+        conf = config.get_options()
     ctx.obj['conn'] = client.create_conn(conf, test_mode)
+    if profile_file is not None:
+        # the connection authenticates with its first call, so get the token now to time it separately
+        profiling.mark('auth')
+        ctx.obj['conn'].auth.refresh_token()
 
 
 def entry():
@@ -92,10 +156,12 @@ def user_read(ctx, output_format, email):
 
     fmtr = _formatter(output_format, _output_fh(), OutputHandler('user_read'))
     umapi_conn = ctx.obj['conn']
+    profiling.mark('query')
     user = UserQuery(umapi_conn, email).result()
     if not user:
         click.echo('No user found')
         sys.exit(1)
+    profiling.mark('output')
     fmtr.record(user)
     fmtr.write()
 
@@ -105,8 +171,13 @@ def user_read(ctx, output_format, email):
 @click.option('-f', '--format', 'output_format', help='Output format', metavar='csv|json|pretty', show_default=True)
 @click.option('-o', '--out-file', help='Write output to this filename', metavar='FILENAME')
 @click.option('-g', '--in-group', help="Limit query to members of GROUP", metavar='GROUP')
+@click.option('-s', '--snapshot', 'snapshot_file', help="Only output users added, changed or removed since the "
+                                                        "snapshot in this file, then update it", metavar='FILENAME')
+@click.option('--sort-by', help="Sort output by this field", type=click.Choice(['email', 'id']))
+@click.option('--split-size', help="Split output file into numbered parts of at most SIZE megabytes",
+              metavar='SIZE', type=click.IntRange(1))
 @click.pass_context
-def user_read_all(ctx, output_format, out_file, in_group):
+def user_read_all(ctx, output_format, out_file, in_group, snapshot_file, sort_by, split_size):
     """Get details for all users belonging to a console"""
 
     if out_file is not None:
@@ -114,16 +185,94 @@ def user_read_all(ctx, output_format, out_file, in_group):
     if output_format is None:
         output_format = 'pretty'
 
-    fmtr = _formatter(output_format, _output_fh(out_file), OutputHandler('user_read_all'))
+    snapshot = None
+    handler = OutputHandler('user_read_all')
+    if snapshot_file is not None:
+        snapshot = Snapshot(snapshot_file, handler.get_fields())
+        handler = OutputHandler('user_delta')
+    fh = sys.stdout
+    if out_file is not None:
+        max_bytes = split_size * 1024 * 1024 if split_size is not None else None
+        fh = formatter.OutputSink(out_file, max_bytes, repeat_header=output_format == 'csv')
+    fmtr = _formatter(output_format, fh, handler)
     umapi_conn = ctx.obj['conn']
-    query = UsersQuery(umapi_conn, in_group=in_group)
+    profiling.mark('query')
+    query = UserStream(umapi_conn, in_group=in_group)
+    try:
+        if sort_by is not None:
+            sorter = ExternalSort(sort_by)
+            for user in _user_records(query, snapshot):
+                sorter.add(user)
+            profiling.mark('output')
+            fmtr.write(sorter.sorted())
+        else:
+            # records are written as pages arrive, so the query and output overlap
+            fmtr.write(_user_records(query, snapshot))
+    finally:
+        if fh is not sys.stdout:
+            fh.close()
+    if snapshot is not None:
+        snapshot.save()
+
+
+def _user_records(query, snapshot=None):
+    """Yield records to output for each user of query, or only changes since snapshot"""
     report_total = True
+    changed = 0
     for user in query:
         total, *_ = query.stats()
         if total is not None and report_total:
             log.info(f"Total records: {total}")
             report_total = False
+        if snapshot is None:
+            yield UserRecord.from_dict(user)
+            continue
+        change = snapshot.compare(user)
+        if change is not None:
+            yield dict(user, change=change)
+            changed += 1
+    if snapshot is not None:
+        for user in snapshot.removed():
+            yield dict(user, change='removed')
+            changed += 1
+        log.info(f"Changed records: {changed}")
+
+
+@app.command()
+@click.help_option('-h', '--help')
+@click.option('-f', '--format', 'input_format', help='Input file format', metavar='csv|json', default='csv',
+              show_default=True)
+@click.option('-i', '--in-file', help='Input filename', metavar='FILENAME', required=True)
+@click.option('-F', '--out-format', 'output_format', help='Output format', metavar='csv|json|pretty')
+@click.option('-o', '--out-file', help='Write output to this filename', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of concurrent user queries', default=4, show_default=True,
+              type=click.IntRange(1, 32))
+@click.pass_context
+def user_read_bulk(ctx, input_format, in_file, output_format, out_file, workers):
+    """Get details for a list of users from an input file"""
+
+    if out_file is not None and output_format is None:
+        output_format = infer_format(out_file)
+    if output_format is None:
+        output_format = 'pretty'
+
+    profiling.mark('input')
+    in_fmtr = _formatter(input_format, _input_fh(in_file), InputHandler('user_read_bulk'))
+    emails = [rec['email'] for rec in in_fmtr.read()]
+    fmtr = _formatter(output_format, _output_fh(out_file), OutputHandler('user_read'))
+    umapi_conn = ctx.obj['conn']
+    profiling.mark('query')
+    found = UserLookup(umapi_conn, workers).lookup(emails)
+    profiling.mark('output')
+    not_found = 0
+    for email in emails:
+        user = found.get(normalize(email))
+        if user is None:
+            click.echo(f"No user found for '{email}'", err=True)
+            not_found += 1
+            continue
         fmtr.record(user)
+    log.info(f"Users found: {len(emails)-not_found}/{len(emails)}")
     fmtr.write()
 
 
@@ -138,8 +287,10 @@ def group_read(ctx, output_format, group_name):
 
     fmtr = _formatter(output_format, _output_fh(), OutputHandler('group_read'))
     umapi_conn = ctx.obj['conn']
+    profiling.mark('query')
     query = GroupsQuery(umapi_conn)
     matched = [g for g in query if normalize(g['groupName']) == normalize(group_name)]
+    profiling.mark('output')
     if len(matched) > 0:
         fmtr.record(matched[0])
         fmtr.write()
@@ -163,12 +314,49 @@ def group_read_all(ctx, output_format, out_file):
 
     fmtr = _formatter(output_format, _output_fh(out_file), OutputHandler('group_read'))
     umapi_conn = ctx.obj['conn']
+    profiling.mark('query')
     query = GroupsQuery(umapi_conn)
     for group in query:
         fmtr.record(group)
+    profiling.mark('output')
     fmtr.write()
 
 
+@app.command()
+@click.help_option('-h', '--help')
+@click.option('-f', '--format', 'output_format', help='Output format', metavar='csv|json|pretty',
+              show_default=True)
+@click.option('-o', '--out-file', help='Write output to this filename', metavar='FILENAME')
+@click.option('-u', '--count-users', help="Also count each profile's users by reading all users", default=False,
+              is_flag=True)
+@click.option('--users-file', help="Count each profile's users from this user-read-all CSV/JSONL export instead "
+                                   "of reading all users", metavar='FILENAME')
+@click.option('--over-allocated', 'over_allocated_only', help="Only report profiles with more members than licenses",
+              default=False, is_flag=True)
+@click.pass_context
+def quota_report(ctx, output_format, out_file, count_users, users_file, over_allocated_only):
+    """Report license utilisation of each product profile"""
+
+    if out_file is not None:
+        output_format = infer_format(out_file)
+    if output_format is None:
+        output_format = 'pretty'
+
+    fmtr = _formatter(output_format, _output_fh(out_file), OutputHandler('quota_report'))
+    umapi_conn = ctx.obj['conn']
+    user_counts = None
+    if users_file is not None:
+        profiling.mark('input')
+        users_fmtr = _formatter(infer_format(users_file) or 'csv', _input_fh(users_file), PassthroughHandler())
+        user_counts = quota.count_users(users_fmtr.iter_read())
+    elif count_users:
+        profiling.mark('query')
+        user_counts = quota.count_users(UserStream(umapi_conn))
+    profiling.mark('query')
+    # profiles are written as group pages arrive
+    fmtr.write(quota.quota_report(GroupsQuery(umapi_conn), user_counts, over_allocated_only))
+
+
 @app.command()
 @click.help_option('-h', '--help')
 @click.option('--type', 'user_type', help="User's identity type", metavar='adobeID|enterpriseID|federatedID',
@@ -205,7 +393,9 @@ def user_create(ctx, user_type, email, username, domain, groups, firstname, last
         groups = groups.split(',')
     queue.queue_user_create_action(user_type, email, country, firstname, lastname,
                                    username, domain, groups)
+    profiling.mark('execute')
     queue.execute()
+    profiling.mark('output')
     errors = queue.errors()
     if errors:
         click.echo("One or more errors occurred")
@@ -219,14 +409,29 @@ def user_create(ctx, user_type, email, username, domain, groups, firstname, last
 @click.option('-f', '--format', 'input_format', help='Input file format', metavar='csv|json', default='csv',
               show_default=True)
 @click.option('-i', '--in-file', help='Input filename', metavar='FILENAME')
+@click.option('--errors-out', help='Write failed input records to this CSV/JSONL file', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of action batches to execute concurrently', default=1,
+              show_default=True, type=click.IntRange(1, 8))
+@click.option('--preflight', help='Check referenced groups and profiles exist before executing any actions',
+              default=False, is_flag=True)
+@click.option('--users-snapshot', help='Also check referenced users against this user-read-all snapshot file',
+              metavar='FILENAME', type=click.Path(exists=True, dir_okay=False))
 @click.pass_context
-def user_create_bulk(ctx, input_format, in_file):
+def user_create_bulk(ctx, input_format, in_file, errors_out, preflight, users_snapshot, workers):
     """Create users in bulk from an input file"""
 
-    fmtr = _formatter(input_format, _input_fh(in_file), InputHandler('user_create_bulk'))
+    handler = InputHandler('user_create_bulk')
+    fmtr = _formatter(input_format, _input_fh(in_file), handler)
     umapi_conn = ctx.obj['conn']
-    queue = ActionQueue(umapi_conn)
-    for user in fmtr.read():
+    profiling.mark('input')
+    records = fmtr.read()
+    if preflight or users_snapshot is not None:
+        profiling.mark('preflight')
+        _preflight(umapi_conn, 'user_create_bulk', records, users_snapshot)
+    profiling.mark('queue')
+    queue = ActionQueue(umapi_conn, _error_sink(errors_out, handler, input_format), workers)
+    for row, user in enumerate(records, start=1):
+        queue.set_source(row, user)
         if user['domain'] == '':
             user['domain'] = None
         queue.queue_user_create_action(id_type=user['type'],
@@ -235,9 +440,10 @@ def user_create_bulk(ctx, input_format, in_file):
                                        firstname=user['firstname'],
                                        lastname=user['lastname'],
                                        country=user['country'])
+    profiling.mark('execute')
     completed = queue.execute()
-    errors = queue.errors()
-    print_bulk_summaries(completed, errors)
+    profiling.mark('output')
+    print_bulk_summaries(completed, queue, errors_out)
 
 
 @app.command()
@@ -253,7 +459,9 @@ def user_delete(ctx, email, hard_delete):
     umapi_conn = ctx.obj['conn']
     queue = ActionQueue(umapi_conn)
     queue.queue_delete_action(email, hard_delete)
+    profiling.mark('execute')
     queue.execute()
+    profiling.mark('output')
     errors = queue.errors()
     if errors:
         click.echo("One or more errors occurred")
@@ -267,19 +475,28 @@ def user_delete(ctx, email, hard_delete):
 @click.option('-f', '--format', 'input_format', help='Input file format', metavar='csv|json', default='csv',
               show_default=True)
 @click.option('-i', '--in-file', help='Input filename', metavar='FILENAME')
+@click.option('--errors-out', help='Write failed input records to this CSV/JSONL file', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of action batches to execute concurrently', default=1,
+              show_default=True, type=click.IntRange(1, 8))
 @click.pass_context
-def user_delete_bulk(ctx, input_format, in_file):
+def user_delete_bulk(ctx, input_format, in_file, errors_out, workers):
     """Delete users in bulk from input file (from org and/or identity directory)"""
 
-    fmtr = _formatter(input_format, _input_fh(in_file), InputHandler('user_delete_bulk'))
+    handler = InputHandler('user_delete_bulk')
+    fmtr = _formatter(input_format, _input_fh(in_file), handler)
     umapi_conn = ctx.obj['conn']
-    queue = ActionQueue(umapi_conn)
-    for user in fmtr.read():
+    profiling.mark('input')
+    records = fmtr.read()
+    profiling.mark('queue')
+    queue = ActionQueue(umapi_conn, _error_sink(errors_out, handler, input_format), workers)
+    for row, user in enumerate(records, start=1):
+        queue.set_source(row, user)
         queue.queue_delete_action(user['email'],
                                   True if user['hard_delete'] == 'y' else False)
+    profiling.mark('execute')
     completed = queue.execute()
-    errors = queue.errors()
-    print_bulk_summaries(completed, errors)
+    profiling.mark('output')
+    print_bulk_summaries(completed, queue, errors_out)
 
 
 @app.command()
@@ -304,7 +521,9 @@ def user_update(ctx, email, email_new, firstname, lastname, username, groups_add
     queue.queue_update_action(email, email_new=email_new, firstname=firstname,
                               lastname=lastname, username=username, add_groups=groups_add,
                               remove_groups=groups_remove)
+    profiling.mark('execute')
     queue.execute()
+    profiling.mark('output')
     errors = queue.errors()
     if errors:
         click.echo("One or more errors occurred")
@@ -318,18 +537,34 @@ def user_update(ctx, email, email_new, firstname, lastname, username, groups_add
 @click.option('-f', '--format', 'input_format', help='Input file format', metavar='csv|json', default='csv',
               show_default=True)
 @click.option('-i', '--in-file', help='Input filename', metavar='FILENAME')
+@click.option('--errors-out', help='Write failed input records to this CSV/JSONL file', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of action batches to execute concurrently', default=1,
+              show_default=True, type=click.IntRange(1, 8))
+@click.option('--preflight', help='Check referenced groups and profiles exist before executing any actions',
+              default=False, is_flag=True)
+@click.option('--users-snapshot', help='Also check referenced users against this user-read-all snapshot file',
+              metavar='FILENAME', type=click.Path(exists=True, dir_okay=False))
 @click.pass_context
-def user_update_bulk(ctx, input_format, in_file):
+def user_update_bulk(ctx, input_format, in_file, errors_out, preflight, users_snapshot, workers):
     """Update users in bulk from input file"""
 
-    fmtr = _formatter(input_format, _input_fh(in_file), InputHandler('user_update_bulk'))
+    handler = InputHandler('user_update_bulk')
+    fmtr = _formatter(input_format, _input_fh(in_file), handler)
     umapi_conn = ctx.obj['conn']
-    queue = ActionQueue(umapi_conn)
-    for user in fmtr.read():
+    profiling.mark('input')
+    records = fmtr.read()
+    if preflight or users_snapshot is not None:
+        profiling.mark('preflight')
+        _preflight(umapi_conn, 'user_update_bulk', records, users_snapshot)
+    profiling.mark('queue')
+    queue = ActionQueue(umapi_conn, _error_sink(errors_out, handler, input_format), workers)
+    for row, user in enumerate(records, start=1):
+        queue.set_source(row, user)
         queue.queue_update_action(**user)
+    profiling.mark('execute')
     completed = queue.execute()
-    errors = queue.errors()
-    print_bulk_summaries(completed, errors)
+    profiling.mark('output')
+    print_bulk_summaries(completed, queue, errors_out)
 
 
 @app.command()
@@ -350,7 +585,9 @@ def group_create(ctx, name, description):
     umapi_conn = ctx.obj['conn']
     queue = ActionQueue(umapi_conn)
     queue.queue_group_create_action(name, description)
+    profiling.mark('execute')
     queue.execute()
+    profiling.mark('output')
     errors = queue.errors()
     if errors:
         click.echo("One or more errors occurred")
@@ -364,18 +601,27 @@ def group_create(ctx, name, description):
 @click.option('-f', '--format', 'input_format', help='Input file format', metavar='csv|json', default='csv',
               show_default=True)
 @click.option('-i', '--in-file', help='Input filename', metavar='FILENAME')
+@click.option('--errors-out', help='Write failed input records to this CSV/JSONL file', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of action batches to execute concurrently', default=1,
+              show_default=True, type=click.IntRange(1, 8))
 @click.pass_context
-def group_create_bulk(ctx, input_format, in_file):
+def group_create_bulk(ctx, input_format, in_file, errors_out, workers):
     """Create groups in bulk from an input file"""
 
-    fmtr = _formatter(input_format, _input_fh(in_file), InputHandler('group_create_bulk'))
+    handler = InputHandler('group_create_bulk')
+    fmtr = _formatter(input_format, _input_fh(in_file), handler)
     umapi_conn = ctx.obj['conn']
-    queue = ActionQueue(umapi_conn)
-    for group in fmtr.read():
+    profiling.mark('input')
+    records = fmtr.read()
+    profiling.mark('queue')
+    queue = ActionQueue(umapi_conn, _error_sink(errors_out, handler, input_format), workers)
+    for row, group in enumerate(records, start=1):
+        queue.set_source(row, group)
         queue.queue_group_create_action(group['name'], group['description'])
+    profiling.mark('execute')
     completed = queue.execute()
-    errors = queue.errors()
-    print_bulk_summaries(completed, errors)
+    profiling.mark('output')
+    print_bulk_summaries(completed, queue, errors_out)
 
 
 @app.command()
@@ -404,7 +650,9 @@ def group_update(ctx, name, name_new, description, users_add, users_remove, prof
     queue.queue_group_update_action(name, name_new=name_new,
                                     description=description, add_users=users_add, remove_users=users_remove,
                                     add_profiles=profiles_add, remove_profiles=profiles_remove)
+    profiling.mark('execute')
     queue.execute()
+    profiling.mark('output')
     errors = queue.errors()
     if errors:
         click.echo("One or more errors occurred")
@@ -418,18 +666,34 @@ def group_update(ctx, name, name_new, description, users_add, users_remove, prof
 @click.option('-f', '--format', 'input_format', help='Input file format', metavar='csv|json', default='csv',
               show_default=True)
 @click.option('-i', '--in-file', help='Input filename', metavar='FILENAME')
+@click.option('--errors-out', help='Write failed input records to this CSV/JSONL file', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of action batches to execute concurrently', default=1,
+              show_default=True, type=click.IntRange(1, 8))
+@click.option('--preflight', help='Check referenced groups and profiles exist before executing any actions',
+              default=False, is_flag=True)
+@click.option('--users-snapshot', help='Also check referenced users against this user-read-all snapshot file',
+              metavar='FILENAME', type=click.Path(exists=True, dir_okay=False))
 @click.pass_context
-def group_update_bulk(ctx, input_format, in_file):
+def group_update_bulk(ctx, input_format, in_file, errors_out, preflight, users_snapshot, workers):
     """Update groups in bulk from input file"""
 
-    fmtr = _formatter(input_format, _input_fh(in_file), InputHandler('group_update_bulk'))
+    handler = InputHandler('group_update_bulk')
+    fmtr = _formatter(input_format, _input_fh(in_file), handler)
     umapi_conn = ctx.obj['conn']
-    queue = ActionQueue(umapi_conn)
-    for group in fmtr.read():
+    profiling.mark('input')
+    records = fmtr.read()
+    if preflight or users_snapshot is not None:
+        profiling.mark('preflight')
+        _preflight(umapi_conn, 'group_update_bulk', records, users_snapshot)
+    profiling.mark('queue')
+    queue = ActionQueue(umapi_conn, _error_sink(errors_out, handler, input_format), workers)
+    for row, group in enumerate(records, start=1):
+        queue.set_source(row, group)
         queue.queue_group_update_action(**group)
+    profiling.mark('execute')
     completed = queue.execute()
-    errors = queue.errors()
-    print_bulk_summaries(completed, errors)
+    profiling.mark('output')
+    print_bulk_summaries(completed, queue, errors_out)
 
 
 @app.command()
@@ -442,7 +706,9 @@ def group_delete(ctx, name):
     umapi_conn = ctx.obj['conn']
     queue = ActionQueue(umapi_conn)
     queue.queue_group_delete_action(name)
+    profiling.mark('execute')
     queue.execute()
+    profiling.mark('output')
     errors = queue.errors()
     if errors:
         click.echo("One or more errors occurred")
@@ -456,18 +722,138 @@ def group_delete(ctx, name):
 @click.option('-f', '--format', 'input_format', help='Input file format', metavar='csv|json', default='csv',
               show_default=True)
 @click.option('-i', '--in-file', help='Input filename', metavar='FILENAME')
+@click.option('--errors-out', help='Write failed input records to this CSV/JSONL file', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of action batches to execute concurrently', default=1,
+              show_default=True, type=click.IntRange(1, 8))
 @click.pass_context
-def group_delete_bulk(ctx, input_format, in_file):
+def group_delete_bulk(ctx, input_format, in_file, errors_out, workers):
     """Delete groups in bulk from input file"""
 
-    fmtr = _formatter(input_format, _input_fh(in_file), InputHandler('group_delete_bulk'))
+    handler = InputHandler('group_delete_bulk')
+    fmtr = _formatter(input_format, _input_fh(in_file), handler)
     umapi_conn = ctx.obj['conn']
-    queue = ActionQueue(umapi_conn)
-    for group in fmtr.read():
+    profiling.mark('input')
+    records = fmtr.read()
+    profiling.mark('queue')
+    queue = ActionQueue(umapi_conn, _error_sink(errors_out, handler, input_format), workers)
+    for row, group in enumerate(records, start=1):
+        queue.set_source(row, group)
         queue.queue_group_delete_action(group['name'])
+    profiling.mark('execute')
     completed = queue.execute()
-    errors = queue.errors()
-    print_bulk_summaries(completed, errors)
+    profiling.mark('output')
+    print_bulk_summaries(completed, queue, errors_out)
+
+
+@app.command()
+@click.help_option('-h', '--help')
+@click.option('-f', '--format', 'input_format', help='Input file format', metavar='csv|json', default='csv',
+              show_default=True)
+@click.option('-i', '--in-file', help='Input filename', metavar='FILENAME')
+@click.option('--errors-out', help='Write failed input records to this CSV/JSONL file', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of action batches to execute concurrently', default=1,
+              show_default=True, type=click.IntRange(1, 8))
+@click.option('--preflight', help='Check referenced groups and profiles exist before executing any actions',
+              default=False, is_flag=True)
+@click.option('--users-snapshot', help='Also check referenced users against this user-read-all snapshot file',
+              metavar='FILENAME', type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def bulk_apply(ctx, input_format, in_file, errors_out, workers, preflight, users_snapshot):
+    """Create/update/delete users and groups from a single input file"""
+
+    handler = OperationHandler()
+    fmtr = _formatter(input_format, _input_fh(in_file), handler)
+    umapi_conn = ctx.obj['conn']
+    profiling.mark('input')
+    records = fmtr.read()
+    if preflight or users_snapshot is not None:
+        profiling.mark('preflight')
+        _preflight(umapi_conn, None, records, users_snapshot)
+    profiling.mark('queue')
+    queue = ActionQueue(umapi_conn, _error_sink(errors_out, handler, input_format), workers)
+    for row, record in enumerate(records, start=1):
+        queue.set_source(row, record)
+        queue.queue_operation(record['op'], record)
+    profiling.mark('execute')
+    completed = queue.execute()
+    profiling.mark('output')
+    print_bulk_summaries(completed, queue, errors_out)
+
+
+@app.command()
+@click.help_option('-h', '--help')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--op', 'default_op', help='Operation for records without an op field',
+              type=click.Choice(list(OperationHandler.operations)))
+@click.option('--state-file', help='File that tracks how far a JSONL file has been read  [default: PATH.offset]',
+              metavar='FILENAME')
+@click.option('-b', '--batch-size', help='Maximum number of records executed together', default=100,
+              show_default=True, type=click.IntRange(1))
+@click.option('--interval', help='Seconds to wait between checks for new records', default=5.0, show_default=True,
+              type=click.FloatRange(0))
+@click.option('--once', help='Process the records that are available and exit', default=False, is_flag=True)
+@click.option('--errors-out', help='Append failed input records to this CSV/JSONL file', metavar='FILENAME')
+@click.option('-w', '--workers', help='Number of action batches to execute concurrently', default=1,
+              show_default=True, type=click.IntRange(1, 8))
+@click.pass_context
+def watch(ctx, path, default_op, state_file, batch_size, interval, once, errors_out, workers):
+    """Apply changes from a growing JSONL file or a spool directory"""
+
+    handler = OperationHandler(default_op)
+    error_sink = None
+    if errors_out is not None:
+        error_sink = formatter.ErrorSink(open(errors_out, 'a', encoding='utf-8'),
+                                         infer_format(errors_out) or 'csv', handler.get_fields())
+
+    def on_invalid(row, record, message):
+        if error_sink is not None:
+            error_sink.write(row, record, [{'message': message}])
+
+    watcher = Watcher(path, handler, state_file, batch_size, on_invalid)
+    umapi_conn = ctx.obj['conn']
+    queue = ActionQueue(umapi_conn, error_sink, workers)
+    completed = 0
+    failed = False
+    try:
+        while True:
+            failed = False
+            for records, commit in watcher.batches():
+                if not records:
+                    commit()
+                    continue
+                for row, record in records:
+                    queue.set_source(row, record)
+                    try:
+                        queue.queue_operation(record['op'], record)
+                    except Exception as e:
+                        log.error(f"Invalid record {row}: {e}")
+                        on_invalid(row, record, str(e))
+                error_count = queue.error_count
+                try:
+                    completed += queue.execute()
+                except BatchError as e:
+                    # the batch isn't committed, so it is read and executed again on the next check
+                    log.error(f"Executing actions failed, the batch will be retried: {e}")
+                    queue.clear()
+                    failed = True
+                    break
+                errors = queue.errors()
+                click.echo(f"Executed {len(queue.actions)} actions, {queue.error_count-error_count} errors")
+                if errors and error_sink is None:
+                    click.echo(render_errors(errors).strip())
+                queue.clear()
+                commit()
+            if once:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if error_sink is not None:
+            error_sink.close()
+    click.echo(f"Executed {completed} actions in total, {queue.error_count} errors")
+    if failed:
+        sys.exit(1)
 
 
 def render_errors(errors):
@@ -495,15 +881,25 @@ def render_summary(summary):
     summary_io.seek(0)
     return summary_io.getvalue()
 
-def print_bulk_summaries(completed, errors):
+def print_bulk_summaries(completed, queue, errors_out=None):
+    if errors_out is not None:
+        # errors were already streamed to the error file, so only report the count
+        queue.error_sink.close()
+        errors = []
+        error_count = queue.error_count
+    else:
+        errors = queue.errors()
+        error_count = len(errors)
     summary = {
         "Executed": completed,
-        "Succeeded": completed-len(errors),
-        "Errors": len(errors),
+        "Succeeded": completed-error_count,
+        "Errors": error_count,
     }
     click.echo("--- Action Summary ---")
     click.echo(render_summary(summary).strip())
     click.echo("----------------------")
+    if errors_out is not None and error_count:
+        click.echo(f"Failed records written to '{errors_out}'")
     if errors:
         click.echo("--- Error Summary ---")
         click.echo(render_errors(errors).strip())
@@ -10,6 +10,8 @@
 
 import os
 
+DEFAULT_CONFIG_FILE = os.path.join(os.path.expanduser('~'), '.config', 'umapi', 'config.toml')
+KEYRING_SERVICE = 'umapi-cli'
 
 keyspec = [{"key": 'UMAPI_CLIENT_ID',     "required": True},
            {"key": 'UMAPI_CLIENT_SECRET', "required": True},
@@ -27,3 +29,47 @@ def get_options():
             raise ValueError(f"Setting '{key['key']}' is required")
         options[key['key']] = val
     return options
+
+
+def get_profile_options(profile_name, config_file=None):
+    """Read options for a named profile from a TOML config file
+
+    Each profile is a [profiles.NAME] table with the UMAPI_* settings as
+    lowercase keys without the prefix (client_id, client_secret, org_id, ...).
+    If keyring is true, the client secret is read from the OS keyring instead.
+    """
+    # only needed for profiles, so .env configuration works without a TOML parser
+    try:
+        import tomllib
+    except ImportError:  # Python < 3.11
+        import tomli as tomllib
+
+    if config_file is None:
+        config_file = DEFAULT_CONFIG_FILE
+    with open(config_file, 'rb') as fh:
+        profiles = tomllib.load(fh).get('profiles', {})
+    if profile_name not in profiles:
+        raise ValueError(f"Profile '{profile_name}' not found in '{config_file}'")
+    profile = dict(profiles[profile_name])
+    if profile.get('keyring') and profile.get('client_secret') is None:
+        profile['client_secret'] = _keyring_secret(profile.get('client_id'))
+    options = {}
+    for key in keyspec:
+        val = profile.get(key['key'][len('UMAPI_'):].lower())
+        if key['required'] and val is None:
+            raise ValueError(f"Setting '{key['key'][len('UMAPI_'):].lower()}' is required in profile "
+                             f"'{profile_name}'")
+        options[key['key']] = val
+    return options
+
+
+def _keyring_secret(client_id):
+    try:
+        import keyring
+    except ImportError:
+        raise ValueError("The keyring package is required to read secrets from the OS keyring "
+                         "(pip install umapi-cli[keyring])")
+    secret = keyring.get_password(KEYRING_SERVICE, client_id)
+    if secret is None:
+        raise ValueError(f"No secret found in keyring for service '{KEYRING_SERVICE}' and client ID '{client_id}'")
+    return secret
@@ -10,7 +10,11 @@
 
 import json as _json
 import csv as _csv
-from schema import Schema, And, Use, Or
+import os
+import queue
+import threading
+import time
+from schema import Schema, SchemaError, And, Use, Or
 
 
 def pretty(fh, record_type):
@@ -33,16 +37,24 @@ def _join_groups(v):
     return ','.join(v)
 
 
+# columns added to records written by ErrorSink
+ERROR_FIELDS = ['source_row', 'error']
+
+
 class InputHandler:
     """Validate and transform input"""
 
     formats = {
+        'user_read_bulk': Schema({
+            "email": And(str, len),
+        }),
         'user_create_bulk': Schema({
             "type": And(str, lambda s: s in ('adobeID', 'federatedID', 'enterpriseID')),
             "email": And(str, len),
             "firstname": Or(None, str),
             "lastname": Or(None, str),
-            "country": Or(None, And(str, lambda s: len(s) == 2)),
+            # an empty CSV cell is a missing country, e.g. a null country written to a CSV error file
+            "country": Or(None, And(str, lambda s: len(s) == 2), And(str, lambda s: not s, Use(lambda _: None))),
             "username": Or(None, str),
             "domain": Or(None, str),
             "groups": Or(None, list, Use(_split_groups)),
@@ -83,10 +95,58 @@ class InputHandler:
         assert fmt in self.formats, "Invalid format"
         self.format = fmt
 
+    def get_fields(self):
+        return list(self.formats[self.format].schema.keys())
+
     def handle(self, rec):
+        # tolerate the extra columns of an error file so it can be used for a retry run
+        rec = {k: v for k, v in rec.items() if k not in ERROR_FIELDS}
         return self.formats[self.format].validate(rec)
 
 
+class OperationHandler:
+    """Validate records of a mixed operation stream with the InputHandler for each record's op"""
+
+    operations = {
+        'user_create': 'user_create_bulk',
+        'user_update': 'user_update_bulk',
+        'user_delete': 'user_delete_bulk',
+        'group_create': 'group_create_bulk',
+        'group_update': 'group_update_bulk',
+        'group_delete': 'group_delete_bulk',
+    }
+
+    def __init__(self, default_op=None):
+        assert default_op is None or default_op in self.operations, "Invalid operation"
+        self.default_op = default_op
+        self.handlers = {op: InputHandler(fmt) for op, fmt in self.operations.items()}
+
+    def get_fields(self):
+        fields = ['op']
+        for handler in self.handlers.values():
+            fields.extend(f for f in handler.get_fields() if f not in fields)
+        return fields
+
+    def handle(self, rec):
+        if not isinstance(rec, dict):
+            raise SchemaError(f"Record must be an object, not {type(rec).__name__}")
+        op = rec.get('op') or self.default_op or ''
+        if not isinstance(op, str):
+            raise SchemaError(f"Invalid op {op!r}")
+        op = op.strip().lower().replace('-', '_')
+        if op not in self.handlers:
+            raise SchemaError(f"Unknown op '{rec.get('op')}'")
+        handler = self.handlers[op]
+        fields = handler.get_fields()
+        # a CSV file has columns for every op, so ignore empty columns other ops use
+        rec = {k: v for k, v in rec.items() if k != 'op' and (k in fields or v not in (None, ''))}
+        for k in fields:
+            rec.setdefault(k, None)
+        rec = handler.handle(rec)
+        rec['op'] = op
+        return rec
+
+
 class OutputHandler:
     """Transform output and prepare for formatting"""
 
@@ -115,6 +175,19 @@ class OutputHandler:
             "groups",
             "tags",
         ],
+        'user_delta': [
+            "change",
+            "id",
+            "type",
+            "email",
+            "firstname",
+            "lastname",
+            "country",
+            "username",
+            "domain",
+            "groups",
+            "tags",
+        ],
         'group_read': [
             'groupName',
             'type',
@@ -123,6 +196,16 @@ class OutputHandler:
             'productName',
             'licenseQuota',
         ],
+        'quota_report': [
+            'groupName',
+            'productName',
+            'memberCount',
+            'userCount',
+            'licenseQuota',
+            'utilisation',
+            'headroom',
+            'overAllocated',
+        ],
     }
 
     def __init__(self, fmt):
@@ -133,8 +216,7 @@ class OutputHandler:
         return self.formats[self.format]
 
     def handle(self, record):
-        fields = self.get_fields()
-        return {k: v for k, v in record.items() if k in fields}
+        return {k: record[k] for k in self.get_fields() if k in record}
 
 
 class PassthroughHandler:
@@ -146,6 +228,173 @@ class PassthroughHandler:
     def handle(self, record):
         return record
 
+class ErrorSink:
+    """Write failed input records to a CSV or JSONL file as soon as errors are reported"""
+
+    def __init__(self, fh, data_format, fields):
+        self.fh = fh
+        self.format = data_format
+        self.fields = ERROR_FIELDS + list(fields)
+        self.writer = None
+        self.count = 0
+
+    def write(self, row, record, errors):
+        rec = {
+            'source_row': row,
+            'error': '; '.join(_error_message(e) for e in errors),
+        }
+        # a record that isn't an object (e.g. a JSONL line '[1]') has no fields to write
+        if isinstance(record, dict):
+            rec.update(record)
+        if self.format == 'csv':
+            if self.writer is None:
+                self.writer = _csv.DictWriter(self.fh, self.fields, lineterminator='\n', extrasaction='ignore')
+                # don't repeat the header when appending to an existing error file
+                if self.fh.tell() == 0:
+                    self.writer.writeheader()
+            self.writer.writerow({k: _join_groups(v) if isinstance(v, (list, tuple)) else v for k, v in rec.items()})
+        else:
+            _json.dump(rec, self.fh)
+            self.fh.write('\n')
+        self.fh.flush()
+        self.count += 1
+
+    def close(self):
+        self.fh.close()
+
+
+def _error_message(error):
+    if 'errorCode' in error:
+        return f"{error['errorCode']}: {error.get('message', '')}"
+    return error.get('message', str(error))
+
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+class OutputSink:
+    """Thread-safe output file that is written by a single background thread
+
+    Each write() call should contain whole records. Writes are passed through
+    a bounded queue to the writer thread, which collects them into blocks of
+    buffer_size bytes, and flushes and fsyncs the file every fsync_interval
+    seconds. If max_bytes is set, the output is split into numbered part files
+    (e.g. users.0001.csv) at record boundaries. With repeat_header, the first
+    write (e.g. a CSV header row) is repeated at the start of each part.
+    """
+
+    def __init__(self, path, max_bytes=None, repeat_header=False, buffer_size=1024*1024,
+                 fsync_interval=30.0, queue_size=1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.repeat_header = repeat_header
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self.paths = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._fh = None
+        self._header = None
+        self._buffer = []
+        self._buffered = 0
+        self._part_size = 0
+        self._synced = time.monotonic()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='output-sink', daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(data)
+        return len(data)
+
+    def flush(self):
+        self._queue.put(_FLUSH)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_CLOSE)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                item = _FLUSH
+            if item is _CLOSE:
+                break
+            if self._error is not None:
+                # keep draining the queue so producers aren't blocked
+                continue
+            try:
+                if item is _FLUSH:
+                    self._sync()
+                else:
+                    self._append(item.encode('utf-8'))
+            except Exception as e:
+                self._error = e
+        try:
+            if self._error is None:
+                if self._fh is None:
+                    # always create the output file, even if nothing was written
+                    self._next_part()
+                self._sync()
+            if self._fh is not None:
+                self._fh.close()
+        except Exception as e:
+            self._error = self._error or e
+
+    def _append(self, data):
+        if self.repeat_header and self._header is None:
+            self._header = data
+        header_size = len(self._header) if self._header is not None else 0
+        if self._fh is None or (self.max_bytes is not None and self._part_size > header_size
+                                and self._part_size + len(data) > self.max_bytes):
+            self._next_part()
+            if self._header is not None and data is not self._header:
+                self._add(self._header)
+        self._add(data)
+        if self._buffered >= self.buffer_size:
+            self._write_buffer()
+        if self.fsync_interval is not None and time.monotonic() - self._synced >= self.fsync_interval:
+            self._sync()
+
+    def _add(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._part_size += len(data)
+
+    def _write_buffer(self):
+        if self._buffer:
+            self._fh.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _sync(self):
+        if self._fh is None:
+            return
+        self._write_buffer()
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._synced = time.monotonic()
+
+    def _next_part(self):
+        if self._fh is not None:
+            self._sync()
+            self._fh.close()
+        path = self.path
+        if self.max_bytes is not None:
+            root, ext = os.path.splitext(self.path)
+            path = f"{root}.{len(self.paths)+1:04d}{ext}"
+        self._fh = open(path, 'wb')
+        self.paths.append(path)
+        self._part_size = 0
+
+
 class Formatter:
     def __init__(self, fh, handler):
         self.records = []
@@ -155,19 +404,27 @@ class Formatter:
     def record(self, record):
         self.records.append(record)
 
-    def write(self):
+    def write(self, records=None):
+        """Write recorded records, or records from the given iterable"""
         pass
 
     def read(self):
         pass
 
+    def iter_read(self):
+        """Yield records one at a time without keeping them"""
+        raise NotImplementedError
+
 
 class PrettyFormatter(Formatter):
-    def write(self):
-        for record in (self.handler.handle(r) for r in self.records):
+    def write(self, records=None):
+        records = self.records if records is None else records
+        for record in (self.handler.handle(r) for r in records):
             formatted = []
             padding = max(map(len, record.keys())) + 1
             for k, v in record.items():
+                if isinstance(v, tuple):
+                    v = list(v)
                 formatted.append("{0:{1}}: {2}".format(k, padding, v))
             formatted.append('\n')
             self.fh.write('\n'.join(formatted))
@@ -177,40 +434,47 @@ class PrettyFormatter(Formatter):
 
 
 class JSONFormatter(Formatter):
-    def write(self):
-        for record in (self.handler.handle(r) for r in self.records):
-            _json.dump(record, self.fh)
-            self.fh.write('\n')
+    def write(self, records=None):
+        records = self.records if records is None else records
+        for record in (self.handler.handle(r) for r in records):
+            self.fh.write(_json.dumps(record) + '\n')
 
     def read(self):
-        for raw_record in self.fh:
-            self.record(self.handler.handle(_json.loads(raw_record)))
+        for record in self.iter_read():
+            self.record(record)
         return self.records
 
+    def iter_read(self):
+        for raw_record in self.fh:
+            yield self.handler.handle(_json.loads(raw_record))
+
 
 class CSVFormatter(Formatter):
-    def write(self):
-        if not self.records:
+    def write(self, records=None):
+        rows = map(self.format_rec, self.records if records is None else records)
+        first = next(rows, None)
+        if first is None:
             return
-        writer = _csv.DictWriter(self.fh, self.handler.get_fields(), lineterminator='\n')
-        writer.writeheader()
-        writer.writerows(map(self.format_rec, self.records))
+        writer = _csv.writer(self.fh, lineterminator='\n')
+        writer.writerow(self.handler.get_fields())
+        writer.writerow(first)
+        writer.writerows(rows)
 
     def read(self):
-        reader = _csv.DictReader(self.fh)
-        for record in reader:
-            self.record(self.handler.handle(record))
+        for record in self.iter_read():
+            self.record(record)
         return self.records
 
+    def iter_read(self):
+        for record in _csv.DictReader(self.fh):
+            yield self.handler.handle(record)
+
     def format_rec(self, record):
-        formatted = {}
-        formatted.update(record)
-        for k, v in record.items():
-            if isinstance(v, list):
-                formatted[k] = ','.join(v)
-            else:
-                formatted[k] = v
-        return self.handler.handle(formatted)
+        row = []
+        for k in self.handler.get_fields():
+            v = record.get(k)
+            row.append(_join_groups(v) if isinstance(v, (list, tuple)) else v)
+        return row
 
 
 def normalize(string):
@@ -0,0 +1,75 @@
+# Copyright 2023 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from umapi_client import UserQuery, UsersQuery
+from .formatter import normalize
+from .record import UserRecord
+from . import log
+
+
+class UserStream(UsersQuery):
+    """UsersQuery that drops each page of results once it has been iterated
+
+    QueryMultiple keeps every page it fetches, which holds a full copy of the
+    org in memory while crawling.
+    """
+
+    def _next_item(self):
+        if self._next_item_index >= len(self._results):
+            self._results = []
+            self._next_item_index = 0
+        return super()._next_item()
+
+
+class UserLookup:
+    """Look up a list of users by email address on a single connection
+
+    The first page of a UsersQuery is fetched to learn the size of the org. If
+    crawling every page takes fewer calls than querying each user, the crawl is
+    used and matched to the emails by hash lookup. Otherwise the users are
+    queried one by one in a thread pool.
+    """
+
+    def __init__(self, conn, workers=4):
+        self.conn = conn
+        self.workers = workers
+
+    def lookup(self, emails):
+        """Return a dict of normalized email -> user record for each user found"""
+        wanted = {normalize(e) for e in emails}
+        if not wanted:
+            return {}
+        query = UserStream(self.conn)
+        users = iter(query)
+        first = next(users, None)
+        if first is None:
+            return {}
+        total, page_count, *_ = query.stats()
+        if page_count <= len(wanted):
+            log.info(f"Looking up {len(wanted)} users by crawling {total} users ({page_count} pages)")
+            return self._crawl(wanted, first, users)
+        log.info(f"Looking up {len(wanted)} users with {self.workers} workers")
+        return self._query(wanted)
+
+    def _crawl(self, wanted, first, users):
+        found = {}
+        for user in itertools.chain([first], users):
+            email = normalize(user.get('email', ''))
+            if email in wanted:
+                found[email] = UserRecord.from_dict(user)
+        return found
+
+    def _query(self, wanted):
+        def query(email):
+            return email, UserQuery(self.conn, email).result()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return {email: user for email, user in executor.map(query, wanted) if user}
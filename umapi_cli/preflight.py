@@ -0,0 +1,65 @@
+# Copyright 2023 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+from .formatter import normalize
+
+
+class ReferenceCheck:
+    """Check group, profile and user references of bulk input records before they are sent"""
+
+    # field -> kind of reference for each bulk input format
+    references = {
+        'user_create_bulk': {
+            'groups': 'group',
+        },
+        'user_update_bulk': {
+            'email': 'user',
+            'add_groups': 'group',
+            'remove_groups': 'group',
+        },
+        'group_update_bulk': {
+            'name': 'group',
+            'add_users': 'user',
+            'remove_users': 'user',
+            'add_profiles': 'group',
+            'remove_profiles': 'group',
+        },
+    }
+
+    def __init__(self, fmt, groups, users=None):
+        assert fmt is None or fmt in self.references, "Invalid format"
+        self.format = fmt
+        self.known = {
+            'group': {normalize(g) for g in groups},
+            'user': None if users is None else {normalize(u) for u in users},
+        }
+
+    def add_known(self, kind, names):
+        """Treat names as known, e.g. because they are created earlier in the same run"""
+        if self.known[kind] is not None:
+            self.known[kind].update(normalize(n) for n in names)
+
+    def check(self, row, record, fmt=None):
+        """Return a list of (row, kind, name) tuples for each unknown reference in record
+
+        fmt overrides the format given to the constructor for a single record.
+        """
+        unknown = []
+        for field, kind in self.references.get(fmt or self.format, {}).items():
+            known = self.known[kind]
+            if known is None:
+                continue
+            names = record.get(field)
+            if not names:
+                continue
+            if not isinstance(names, list):
+                names = [names]
+            unknown.extend((row, kind, n) for n in names if normalize(n) not in known)
+        return unknown
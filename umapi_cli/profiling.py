@@ -0,0 +1,61 @@
+# Copyright 2023 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import cProfile
+import pstats
+import time
+from . import log
+
+_profiler = None
+_phases = {}
+_current = None
+
+
+def start():
+    global _profiler, _phases, _current
+    _phases = {}
+    _current = None
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+
+def mark(phase):
+    """End the current phase and start timing the given one. Does nothing unless profiling"""
+    global _current
+    if _profiler is None:
+        return
+    now = time.perf_counter()
+    if _current is not None:
+        name, started = _current
+        _phases[name] = _phases.get(name, 0.0) + now - started
+    _current = (phase, now) if phase is not None else None
+
+
+def stop(path, command=None):
+    """Write the cProfile dump to path and a phase breakdown report to path + '.txt'"""
+    global _profiler
+    if _profiler is None:
+        return
+    mark(None)
+    _profiler.disable()
+    _profiler.dump_stats(path)
+    total = sum(_phases.values())
+    with open(f"{path}.txt", 'w', encoding='utf-8') as fh:
+        fh.write(f"Command: {command}\n")
+        fh.write(f"Total wall-clock time: {total:.3f}s\n\n")
+        fh.write("Phase breakdown:\n")
+        for name, elapsed in _phases.items():
+            share = elapsed / total * 100 if total else 0
+            fh.write(f"   {name:10}: {elapsed:9.3f}s ({share:5.1f}%)\n")
+        fh.write("\n")
+        stats = pstats.Stats(_profiler, stream=fh)
+        stats.sort_stats('cumulative').print_stats(40)
+    log.info(f"Profile written to '{path}' and '{path}.txt'")
+    _profiler = None
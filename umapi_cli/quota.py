@@ -0,0 +1,62 @@
+# Copyright 2023 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+from collections import Counter
+from .formatter import normalize
+
+
+def count_users(users):
+    """Count users of each group from the groups field of user records"""
+    counts = Counter()
+    for user in users:
+        groups = user.get('groups') or []
+        if isinstance(groups, str):
+            groups = [g for g in groups.split(',') if g]
+        counts.update(normalize(g) for g in groups)
+    return counts
+
+
+def quota_report(groups, user_counts=None, over_allocated_only=False):
+    """Yield a license utilisation record for each product profile in groups
+
+    Utilisation and headroom are based on the memberCount reported for the
+    profile. Profiles without a numeric licenseQuota (e.g. unlimited quota)
+    have no utilisation or headroom.
+    """
+    for group in groups:
+        if group.get('type') != 'PRODUCT_PROFILE':
+            continue
+        members = int(group.get('memberCount') or 0)
+        quota = _quota(group.get('licenseQuota'))
+        record = {
+            'groupName': group['groupName'],
+            'productName': group.get('productName'),
+            'memberCount': members,
+            'licenseQuota': group.get('licenseQuota'),
+            'utilisation': None,
+            'headroom': None,
+            'overAllocated': False,
+        }
+        if user_counts is not None:
+            record['userCount'] = user_counts.get(normalize(group['groupName']), 0)
+        if quota is not None:
+            record['utilisation'] = round(members / quota * 100, 1) if quota else None
+            record['headroom'] = quota - members
+            record['overAllocated'] = members > quota
+        if over_allocated_only and not record['overAllocated']:
+            continue
+        yield record
+
+
+def _quota(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,51 @@
+# Copyright 2023 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import sys
+
+
+class UserRecord:
+    """Compact, read-only user record for holding large numbers of users in memory
+
+    Only the fields that are written by the output formatters are kept. Group
+    names and tags are interned tuples, so each distinct name is stored once
+    no matter how many users reference it. Records support the read-only
+    mapping methods used by the formatters, so they are written directly
+    without being converted back to dicts.
+    """
+
+    __slots__ = ('id', 'type', 'email', 'firstname', 'lastname', 'country', 'username', 'domain', 'groups', 'tags')
+
+    def __init__(self, **fields):
+        for k, v in fields.items():
+            if k in ('groups', 'tags') and v is not None:
+                v = tuple(sys.intern(i) for i in v)
+            setattr(self, k, v)
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(**{k: v for k, v in record.items() if k in cls.__slots__})
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [k for k in self.__slots__ if hasattr(self, k)]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
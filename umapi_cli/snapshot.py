@@ -0,0 +1,71 @@
+# Copyright 2023 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import hashlib
+import json
+import os
+from . import log
+
+
+class Snapshot:
+    """Digest of every record from a previous export, keyed by ID
+
+    Only a digest and the email address of each record are kept, so the
+    snapshot stays small even for large orgs.
+    """
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+        self.previous = self._load()
+        self.current = {}
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            log.info(f"No snapshot found at '{self.path}', all records will be reported as added")
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as fh:
+            entries = (json.loads(line) for line in fh if line.strip())
+            return {e['id']: (e['digest'], e['email']) for e in entries}
+
+    def digest(self, record):
+        values = {}
+        for k in self.fields:
+            v = record.get(k)
+            values[k] = sorted(v) if isinstance(v, (list, tuple)) else v
+        return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def compare(self, record):
+        """Track record and return 'added', 'changed' or None if it is unchanged"""
+        digest = self.digest(record)
+        self.current[record['id']] = (digest, record.get('email'))
+        previous = self.previous.pop(record['id'], None)
+        if previous is None:
+            return 'added'
+        if previous[0] != digest:
+            return 'changed'
+        return None
+
+    def emails(self):
+        """Email addresses of all records in the previous snapshot"""
+        return [email for _, email in self.previous.values() if email]
+
+    def removed(self):
+        """Records in the previous snapshot that were not seen by compare()"""
+        for rec_id, (_, email) in self.previous.items():
+            yield {'id': rec_id, 'email': email}
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            for rec_id, (digest, email) in self.current.items():
+                json.dump({'id': rec_id, 'digest': digest, 'email': email}, fh)
+                fh.write('\n')
+        os.replace(tmp_path, self.path)
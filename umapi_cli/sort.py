@@ -0,0 +1,76 @@
+# Copyright 2023 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import heapq
+import json
+import os
+import tempfile
+from .formatter import normalize
+from . import log
+
+
+class ExternalSort:
+    """Sort records on a single field with bounded memory
+
+    Records are collected in chunks of chunk_size. Each full chunk is sorted
+    and spilled to a JSONL file in a temporary directory, and the spilled
+    chunks are merged when the sorted records are read back.
+    """
+
+    def __init__(self, field, chunk_size=50000):
+        self.field = field
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.tmp_dir = None
+        self.spills = []
+
+    def sort_key(self, record):
+        value = record.get(self.field)
+        return normalize(value) if value else ''
+
+    def add(self, record):
+        self.chunk.append(record)
+        if len(self.chunk) >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix='umapi-sort-')
+        self.chunk.sort(key=self.sort_key)
+        path = os.path.join(self.tmp_dir.name, f"chunk-{len(self.spills)}.jsonl")
+        with open(path, 'w', encoding='utf-8') as fh:
+            for record in self.chunk:
+                json.dump(dict(record.items()), fh)
+                fh.write('\n')
+        log.debug(f"Spilled {len(self.chunk)} records to {path}")
+        self.spills.append(path)
+        self.chunk = []
+
+    def _read_spill(self, path):
+        with open(path, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                yield json.loads(line)
+
+    def sorted(self):
+        """Yield all added records in sorted order, then remove spilled chunks"""
+        if not self.spills:
+            self.chunk.sort(key=self.sort_key)
+            yield from self.chunk
+            self.chunk = []
+            return
+        if self.chunk:
+            self._spill()
+        log.info(f"Merging {len(self.spills)} sorted chunks")
+        try:
+            yield from heapq.merge(*map(self._read_spill, self.spills), key=self.sort_key)
+        finally:
+            self.tmp_dir.cleanup()
+            self.tmp_dir = None
+            self.spills = []
@@ -0,0 +1,138 @@
+# Copyright 2023 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import functools
+import json
+import os
+from . import formatter
+from . import log
+
+
+class Watcher:
+    """Read new input records from a growing JSONL file or a spool directory
+
+    batches() yields lists of (row, record) tuples together with a commit
+    function. Progress is only saved when commit is called, so records of a
+    batch that wasn't committed are read again after a restart.
+
+    A JSONL file is tailed from the byte offset saved in state_file. Files in
+    a spool directory are read in name order and moved to its 'done'
+    subdirectory once committed.
+    """
+
+    spool_formats = {'.csv': 'csv', '.json': 'json', '.jsonl': 'json'}
+
+    def __init__(self, path, handler, state_file=None, batch_size=100, on_invalid=None):
+        self.path = path
+        self.handler = handler
+        self.batch_size = batch_size
+        self.on_invalid = on_invalid
+        self.spool = os.path.isdir(path)
+        if not self.spool and not path.endswith(('.json', '.jsonl')):
+            raise ValueError("Only JSONL files can be watched, use a spool directory for CSV files")
+        self.state_file = state_file if state_file is not None else f"{path}.offset"
+
+    def batches(self):
+        if self.spool:
+            yield from self._spool_batches()
+        else:
+            yield from self._tail_batches()
+
+    def _invalid(self, row, record, message):
+        log.error(f"Invalid record {row}: {message}")
+        if self.on_invalid is not None:
+            self.on_invalid(row, record, message)
+
+    def _validate(self, row, raw):
+        """Parse (if needed) and validate a raw record, returning None if it is invalid"""
+        try:
+            record = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+        except ValueError as e:
+            self._invalid(row, {}, f"Invalid JSON: {e}")
+            return None
+        try:
+            return self.handler.handle(record)
+        except Exception as e:
+            # a bad record must not stop the watcher, or it would fail on the same record after every restart
+            self._invalid(row, record, str(e))
+            return None
+
+    def _load_offset(self):
+        if not self.spool and os.path.exists(self.state_file):
+            with open(self.state_file, 'r', encoding='utf-8') as fh:
+                state = json.load(fh)
+            return state['offset'], state['line']
+        return 0, 0
+
+    def _save_offset(self, offset, line):
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump({'offset': offset, 'line': line}, fh)
+        os.replace(tmp_path, self.state_file)
+
+    def _tail_batches(self):
+        if not os.path.exists(self.path):
+            return
+        offset, line = self._load_offset()
+        if os.path.getsize(self.path) < offset:
+            log.warn(f"'{self.path}' is smaller than the saved offset, reading it from the start")
+            offset, line = 0, 0
+        with open(self.path, 'rb') as fh:
+            fh.seek(offset)
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    raw = fh.readline()
+                    # stop at the end of the file or at a line that is still being written
+                    if not raw.endswith(b'\n'):
+                        fh.seek(-len(raw), os.SEEK_CUR)
+                        break
+                    line += 1
+                    if not raw.strip():
+                        continue
+                    record = self._validate(line, raw)
+                    if record is not None:
+                        batch.append((line, record))
+                end, end_line = fh.tell(), line
+                if end == offset:
+                    return
+                yield batch, functools.partial(self._save_offset, end, end_line)
+                offset = end
+
+    def _spool_batches(self):
+        done_dir = os.path.join(self.path, 'done')
+        for name in sorted(os.listdir(self.path)):
+            data_format = self.spool_formats.get(os.path.splitext(name)[1])
+            path = os.path.join(self.path, name)
+            if data_format is None or not os.path.isfile(path):
+                continue
+            log.info(f"Reading '{path}'")
+            with open(path, 'r', encoding='utf-8') as fh:
+                if data_format == 'csv':
+                    raw_records = formatter.CSVFormatter(fh, formatter.PassthroughHandler()).read()
+                else:
+                    raw_records = [raw for raw in fh if raw.strip()]
+            records = []
+            for row, raw in enumerate(raw_records, start=1):
+                record = self._validate(f"{name}:{row}", raw)
+                if record is not None:
+                    records.append((f"{name}:{row}", record))
+            done = functools.partial(os.replace, path, os.path.join(done_dir, name))
+            os.makedirs(done_dir, exist_ok=True)
+            if not records:
+                done()
+                continue
+            for start in range(0, len(records), self.batch_size):
+                last = start + self.batch_size >= len(records)
+                yield records[start:start+self.batch_size], done if last else _no_commit
+
+
+def _no_commit():
+    pass